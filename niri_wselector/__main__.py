@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
-from dataclasses import dataclass
-from functools import cache, cached_property, partial
+from contextlib import suppress
+from dataclasses import dataclass, field
 import sys
 import json
 import subprocess
 import argparse
+from operator import itemgetter
 from typing import (
     Any,
+    Callable,
+    Iterable,
     Mapping,
     NotRequired,
     Protocol,
@@ -18,32 +21,33 @@ from typing import (
     TypedDict,
 )
 
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 OutType = TypeVar("OutType")
 
 
-def niri_json_from_msg_raw(*msg: str, type: Type[OutType] = list) -> OutType:
-    proc = subprocess.Popen(["niri", "msg", "--json", *msg], stdout=subprocess.PIPE)
-    proc.wait()
+def _open_niri(*msg: str) -> subprocess.Popen:
+    """Spawns `niri msg --json ...` without waiting for it to finish"""
+    return subprocess.Popen(["niri", "msg", "--json", *msg], stdout=subprocess.PIPE)
+
+
+def _finish(proc: subprocess.Popen, type: Type[OutType] = list) -> OutType:
+    """Waits for a process created by _open_niri and decodes its output"""
+    out, _ = proc.communicate()
     if proc.returncode != 0:
         raise Exception(f"niri returned non-zero status {proc.returncode}")
 
-    if not proc.stdout:
+    if not out:
         raise Exception("No output from niri")
 
-    output = json.loads(proc.stdout.read())
+    output = _loads(out)
 
     return output
 
 
-@cache
-def _niri_json_from_msg_cached(*msg: str, type: Type[OutType] = list) -> OutType:
-    return niri_json_from_msg_raw(*msg, type=type)
-
-
-def niri_json_from_msg(*msg: str, type: Type[OutType] = list) -> OutType:
-    """Simple wrapper, just to avoid typing information being lost with cache"""
-    return _niri_json_from_msg_cached(*msg, type=type)
-
 class WindowLayoutDict(TypedDict):
     pos_in_scrolling_layout: Tuple[int, int]
 
@@ -75,36 +79,65 @@ class NiriState:
     windows: Sequence[WindowEntryDict]
     workspaces: Sequence[WorkspaceEntryDict]
 
+    window_id_map: dict[int, WindowEntryDict] = field(init=False, repr=False)
+    workspace_id_map: dict[int, WorkspaceEntryDict] = field(init=False, repr=False)
+    _focused_window: WindowEntryDict | None = field(init=False, repr=False)
+    _focused_workspace: WorkspaceEntryDict | None = field(init=False, repr=False)
+    _active_workspaces: list[WorkspaceEntryDict] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Classify everything in a single pass over each list
+        self.window_id_map = {}
+        self._focused_window = None
+        for w in self.windows:
+            self.window_id_map[w["id"]] = w
+            if self._focused_window is None and w["is_focused"]:
+                self._focused_window = w
+
+        self.workspace_id_map = {}
+        self._focused_workspace = None
+        self._active_workspaces = []
+        for w in self.workspaces:
+            self.workspace_id_map[w["id"]] = w
+            if self._focused_workspace is None and w["is_focused"]:
+                self._focused_workspace = w
+            if w["is_active"]:
+                self._active_workspaces.append(w)
+
     @classmethod
     def new(cls):
-        windows = niri_json_from_msg("windows", type=Sequence[WindowEntryDict])
-        workspaces = niri_json_from_msg(
-            "workspaces", type=Sequence[WorkspaceEntryDict]
-        )
+        # Spawn both requests before waiting on any of them
+        windows_proc = _open_niri("windows")
+        workspaces_proc = _open_niri("workspaces")
+
+        windows = _finish(windows_proc, type=Sequence[WindowEntryDict])
+        workspaces = _finish(workspaces_proc, type=Sequence[WorkspaceEntryDict])
 
         return cls(windows=windows, workspaces=workspaces)
 
-    @cached_property
+    @property
     def focused_window(self) -> WindowEntryDict | None:
-        return next((w for w in self.windows if w["is_focused"]), None)
+        return self._focused_window
 
-    @cached_property
+    @property
     def focused_workspace(self) -> WorkspaceEntryDict | None:
-        return next((w for w in self.workspaces if w["is_focused"]), None)
+        return self._focused_workspace
 
-    @cached_property
+    @property
     def active_workspaces(self) -> Sequence[WorkspaceEntryDict]:
-        return [w for w in self.workspaces if w["is_active"]]
+        return self._active_workspaces
 
-    @cached_property
+    @property
     def focused_output(self) -> str | None:
-        if focused := self.focused_workspace:
+        if focused := self._focused_workspace:
             return focused.get("output")
 
 
 class Matcher(Protocol):
     def matches(self, item: Mapping[Any, Any]) -> bool: ...
 
+    def predicate(self) -> Callable[[Mapping[Any, Any]], bool]: ...
+
 
 class DictKeyMatcher:
     def __init__(self, key, value):
@@ -114,43 +147,72 @@ class DictKeyMatcher:
     def matches(self, item: Mapping) -> bool:
         return item.get(self.key) == self.value
 
+    def predicate(self) -> Callable[[Mapping], bool]:
+        key, value = self.key, self.value
+        return lambda item: item.get(key) == value
+
 
 class DictKeyAnyMatcher:
     def __init__(self, key, *values):
         self.key = key
-        self.values = values
+        # Scanning a tiny tuple is cheaper than hashing
+        self.values = values if len(values) <= 2 else frozenset(values)
+
+    @classmethod
+    def from_iterable(cls, key, values: Iterable):
+        return cls(key, *values)
 
     def matches(self, item: Mapping) -> bool:
         return item.get(self.key) in self.values
 
+    def predicate(self) -> Callable[[Mapping], bool]:
+        key, values = self.key, self.values
+        return lambda item: item.get(key) in values
 
-def _filter_item_matches(filters: Sequence[Matcher], item: Mapping):
-    return all(rule.matches(item) for rule in filters)
+
+def compile_filters(filters: Sequence[Matcher]) -> Callable[[Mapping], bool]:
+    """Builds a single predicate checking all the filters"""
+    predicates = tuple(rule.predicate() for rule in filters)
+
+    match predicates:
+        case ():
+            return lambda item: True
+        case (p,):
+            return p
+        case (p1, p2):
+            return lambda item: p1(item) and p2(item)
+        case _:
+            return lambda item: all(p(item) for p in predicates)
 
 
 FilterItem = TypeVar("FilterItem", bound=Mapping)
 
 
 def filter_by_dict(d: Sequence[FilterItem], filters: Sequence[Matcher]):
-    filter_fn = partial(_filter_item_matches, filters)
-    return filter(filter_fn, d)
+    return filter(compile_filters(filters), d)
 
 
 MIN = -sys.maxsize - 1
 MAX = sys.maxsize
 
+# Stands in for the active window of empty workspaces
+EMPTY_WINDOW = {"title": "(empty)"}
+
 class WindowHandler:
     def __init__(self, niri: NiriState, select_focused: bool, window_filters: Sequence[Matcher] | None):
         self.niri = niri
-        self.workspace_id_map = {w["id"]: w for w in self.niri.workspaces}
+        self.workspace_id_map = self.niri.workspace_id_map
         windows = self.niri.windows
 
         if window_filters:
             windows = list(filter_by_dict(windows, window_filters))
 
+        # Hoisted out of sort_key, which runs once per window
+        focused_output = niri.focused_output
+        wmap = self.workspace_id_map
+
         # Sort windows by workspace, keeping the
-        def sort_key(w: WindowEntryDict):
-            workspace = self.workspace_id_map[w["workspace_id"]]
+        def sort_key(w: WindowEntryDict, workspace: WorkspaceEntryDict):
             output = workspace.get("output")
 
             urgent_prio = MIN if w.get("is_urgent") else 0
@@ -168,7 +230,7 @@ class WindowHandler:
             else:
                 workspace_prio = 0
 
-            output_prio = MIN if output == niri.focused_output else 0
+            output_prio = MIN if output == focused_output else 0
 
             layout = w.get("layout", {})
             grid_pos = layout.get("pos_in_scrolling_layout")
@@ -176,42 +238,77 @@ class WindowHandler:
 
             return urgent_prio, workspace_prio, window_prio, output_prio, output, grid_prio, workspace["idx"], w["id"]
 
-        self.windows = list(sorted(windows, key=sort_key))
-        self.multiple_workspaces = (
-            len(set(win["workspace_id"] for win in self.windows)) > 1
-        )
-        self.multiple_outputs = (
-            len(
-                set(
-                    self.workspace_id_map[win["workspace_id"]].get("output")
-                    for win in self.windows
-                )
-            )
-            > 1
-        )
+        if len(windows) <= 1:
+            # Nothing to sort, and a single window spans a single workspace
+            decorated = [(None, w, wmap[w["workspace_id"]]) for w in windows]
+            self.multiple_workspaces = False
+            self.multiple_outputs = False
+        else:
+            # Materialize the keys once, then sort on them alone. The same pass
+            # collects the workspaces and outputs the windows are spread over
+            decorated = []
+            ws_ids = set()
+            outputs = set()
+            for w in windows:
+                workspace = wmap[w["workspace_id"]]
+                ws_ids.add(workspace["id"])
+                outputs.add(workspace.get("output"))
+                decorated.append((sort_key(w, workspace), w, workspace))
+            decorated.sort(key=itemgetter(0))
+
+            self.multiple_workspaces = len(ws_ids) > 1
+            self.multiple_outputs = len(outputs) > 1
+
+        self.windows = [w for _, w, _ in decorated]
+
+        # The flags hold for the whole batch, pick the formatter only once
+        if not self.multiple_workspaces:
+            self._fmt_entry = self._fmt_plain
+        elif not self.multiple_outputs:
+            self._fmt_entry = self._fmt_ws
+        else:
+            self._fmt_entry = self._fmt_ws_out
 
         self.dmenu_prompt = "Window"
-        self.dmenu_entries = [self._entry_to_dmenu(w) for w in self.windows]
+        self.dmenu_entries: list[bytes] = [
+            self._fmt_entry(w, workspace).encode("utf-8")
+            for _, w, workspace in decorated
+        ]
         self.dmenu_selected = (
-            self._entry_to_dmenu(self.niri.focused_window)
-            if select_focused and self.niri.focused_window
+            self._fmt_entry(
+                focused_window,
+                self.workspace_id_map.get(focused_window["workspace_id"]),
+            )
+            if select_focused and (focused_window := self.niri.focused_window)
             else None
         )
 
-    def _entry_to_dmenu(self, entry: WindowEntryDict) -> str:
-        entry_dmenu = entry["title"]
-        if entry["is_focused"]:
-            entry_dmenu = f"* {entry_dmenu}"
+    def _fmt_plain(
+        self, entry: WindowEntryDict, workspace: WorkspaceEntryDict | None
+    ) -> str:
+        return f"* {entry['title']}" if entry["is_focused"] else entry["title"]
+
+    def _fmt_ws(
+        self, entry: WindowEntryDict, workspace: WorkspaceEntryDict | None
+    ) -> str:
+        title = f"* {entry['title']}" if entry["is_focused"] else entry["title"]
+        if not workspace:
+            return title
 
-        if self.multiple_workspaces and (
-            workspace := self.workspace_id_map.get(entry["workspace_id"])
-        ):
-            workspace_name = workspace.get("name") or str(workspace["idx"])
-            if self.multiple_outputs and (output := workspace.get("output")):
-                workspace_name += f" / {output}"
-            entry_dmenu += f" (@{workspace_name})"
+        return f"{title} (@{workspace.get('name') or workspace['idx']})"
 
-        return entry_dmenu
+    def _fmt_ws_out(
+        self, entry: WindowEntryDict, workspace: WorkspaceEntryDict | None
+    ) -> str:
+        title = f"* {entry['title']}" if entry["is_focused"] else entry["title"]
+        if not workspace:
+            return title
+
+        name = workspace.get("name") or workspace["idx"]
+        if output := workspace.get("output"):
+            return f"{title} (@{name} / {output})"
+
+        return f"{title} (@{name})"
 
     def select(self, idx: int):
         entry = self.windows[idx]
@@ -222,9 +319,10 @@ class WindowHandler:
 class WorkspaceHandler:
     def __init__(self, niri: NiriState, select_focused: bool):
         self.niri = niri
-        self.window_id_map = {w["id"]: w for w in self.niri.windows}
+        self.window_id_map = self.niri.window_id_map
 
         workspaces = self.niri.workspaces
+        focused_output = niri.focused_output
 
         def sort_key(w: WorkspaceEntryDict):
             if w["is_focused"]:
@@ -234,36 +332,43 @@ class WorkspaceHandler:
             else:
                 focus_prio = 0
 
-            output_prio = -1 if w.get("output") == self.niri.focused_output else 0
+            output_prio = -1 if w.get("output") == focused_output else 0
 
             return focus_prio, output_prio, w.get("output"), w["idx"]
 
-        self.workspaces = list(sorted(workspaces, key=sort_key))
-        self.multiple_outputs = len(set(w.get("output") for w in self.workspaces)) > 1
+        if len(workspaces) <= 1:
+            self.workspaces = list(workspaces)
+            self.multiple_outputs = False
+        else:
+            decorated = [(sort_key(w), w) for w in workspaces]
+            decorated.sort(key=itemgetter(0))
+
+            self.workspaces = [w for _, w in decorated]
+            self.multiple_outputs = len(set(w.get("output") for w in self.workspaces)) > 1
+
+        self._fmt_entry = self._fmt_out if self.multiple_outputs else self._fmt_plain
 
         self.dmenu_prompt = "Workspace"
-        self.dmenu_entries = [self._entry_to_dmenu(w) for w in self.workspaces]
+        self.dmenu_entries: list[bytes] = [
+            self._fmt_entry(w).encode("utf-8") for w in self.workspaces
+        ]
         self.dmenu_selected = (
-            self._entry_to_dmenu(self.niri.focused_workspace)
+            self._fmt_entry(self.niri.focused_workspace)
             if select_focused and self.niri.focused_workspace
             else None
         )
 
-    def _entry_to_dmenu(self, entry: WorkspaceEntryDict):
-        entry_name = entry.get("name") or entry["idx"]
-        entry_dmenu = f"@{entry_name}"
-        if entry["is_focused"]:
-            entry_dmenu = f"* {entry_dmenu}"
+    def _fmt_plain(self, entry: WorkspaceEntryDict) -> str:
+        name = entry.get("name") or entry["idx"]
+        title = self.window_id_map.get(entry["active_window_id"], EMPTY_WINDOW)["title"]
+        return f"* @{name} -- {title}" if entry["is_focused"] else f"@{name} -- {title}"
 
-        if self.multiple_outputs and (output := entry.get("output")):
-            entry_dmenu = f"{entry_dmenu} / {output}"
-
-        focused_window = self.window_id_map.get(
-            entry["active_window_id"], {"title": "(empty)"}
-        )
-        entry_dmenu = f"{entry_dmenu} -- {focused_window['title']}"
-
-        return entry_dmenu
+    def _fmt_out(self, entry: WorkspaceEntryDict) -> str:
+        name = entry.get("name") or entry["idx"]
+        if output := entry.get("output"):
+            name = f"{name} / {output}"
+        title = self.window_id_map.get(entry["active_window_id"], EMPTY_WINDOW)["title"]
+        return f"* @{name} -- {title}" if entry["is_focused"] else f"@{name} -- {title}"
 
     def select(self, idx: int):
         entry = self.workspaces[idx]
@@ -327,6 +432,7 @@ def main():
 
     if args.windows:
         workspace_matchers = []
+        workspace_ids = None
         window_filters = []
 
         match args.app_id:
@@ -357,9 +463,11 @@ def main():
             case None:
                 pass
             case "@focused":
-                workspace_matchers.append(DictKeyMatcher("is_focused", True))
+                # NiriState already knows these, no need to filter
+                focused_workspace = niri.focused_workspace
+                workspace_ids = {focused_workspace["id"]} if focused_workspace else set()
             case "@active":
-                workspace_matchers.append(DictKeyMatcher("is_active", True))
+                workspace_ids = {w["id"] for w in niri.active_workspaces}
             case "@output" if (output := niri.focused_output):
                 workspace_matchers.append(DictKeyAnyMatcher("output", output))
             case str() if (workspace_matchers_arg := _parse_arg_as_json_dict(args.workspace)):
@@ -373,13 +481,16 @@ def main():
 
         if workspace_matchers:
             filtered_workspaces = filter_by_dict(niri.workspaces, workspace_matchers)
-            _ids = {w["id"] for w in filtered_workspaces}
+            workspace_ids = {w["id"] for w in filtered_workspaces}
 
-            if not _ids:
+        if workspace_ids is not None:
+            if not workspace_ids:
                 print("Could not found workspaces by provided rules", file=sys.stderr)
                 sys.exit(1)
 
-            window_filters.append(DictKeyAnyMatcher("workspace_id", *_ids))
+            window_filters.append(
+                DictKeyAnyMatcher.from_iterable("workspace_id", workspace_ids)
+            )
 
         handler = WindowHandler(niri, args.select_focused, window_filters=window_filters)
     elif args.workspaces:
@@ -398,10 +509,17 @@ def main():
         f"{prompt}: ",
     ]
 
-    if not any(arg.startswith("--match-mode") for arg in fuzzel_args):
+    has_match_mode = has_width = False
+    for arg in fuzzel_args:
+        if arg.startswith("--match-mode"):
+            has_match_mode = True
+        elif arg == "-w" or arg.startswith(("--width", "-w=")):
+            has_width = True
+
+    if not has_match_mode:
         cmd.append("--match-mode=fuzzy")
 
-    if not any(arg.startswith("--width") or arg == "-w" or arg.startswith("-w=") for arg in fuzzel_args):
+    if not has_width:
         cmd.append(f"--width={args.width}")
 
     if handler.dmenu_selected:
@@ -411,15 +529,31 @@ def main():
         cmd += fuzzel_args[1:]  # drop `--`
 
     fuzzel = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    out, err = fuzzel.communicate(input="\n".join(handler.dmenu_entries).encode("utf-8"))
+    if not fuzzel.stdin or not fuzzel.stdout:
+        raise Exception("Could not communicate with fuzzel")
+
+    # Write the entries straight into the pipe, no need for communicate's
+    # reader thread: fuzzel only answers after reading all of its input
+    entries = handler.dmenu_entries
+    # If fuzzel goes away before reading everything, its status tells why
+    try:
+        if entries:
+            fuzzel.stdin.writelines(e + b"\n" for e in entries[:-1])
+            fuzzel.stdin.write(entries[-1])
+    except BrokenPipeError:
+        pass
+    finally:
+        with suppress(BrokenPipeError):
+            fuzzel.stdin.close()
+
+    out = fuzzel.stdout.read()
+    fuzzel.wait()
 
     if fuzzel.returncode != 0:
         out_str = out.decode("utf-8")
-        err_str = (err or b"").decode("utf-8")
-        if out_str or err_str:
+        if out_str:
             print(f"Error: fuzzel returned non-zero status code: {fuzzel.returncode}")
             print(f"Fuzzel output:\n{out_str}")
-            print(err_str, file=sys.stderr)
 
         sys.exit(2)
 